@@ -1,64 +1,88 @@
 # --------------------------------------------------------------------------
-# CONFIGURATION FILE FOR ANEEL BDGD DOWNLOADER AND MAPPER
+# CONFIGURATION LOADER FOR ANEEL BDGD DOWNLOADER AND MAPPER
 # --------------------------------------------------------------------------
+# The settings themselves live in config.toml; edit that file, not this one.
+import functools
+import os
+import re
+import tomllib
+from dataclasses import dataclass, field
+from typing import Optional
 
-# --- Download Settings ---
-# Filter datasets by company name (e.g., 'Energisa', 'CELESC'). Leave as "" to download all.
-# COMPANY_FILTER = "ENERGISA_AC"
-COMPANY_FILTER = "CERAL_ARARUAMA"
-# COMPANY_FILTER = "LIGHT"
-# COMPANY_FILTER = ""
+import pyproj
 
-# Filter datasets by a tag or string in the filename (e.g., '2023-12-31', '2022'). Leave as "" for no date filter.
-DATE_FILTER = "2024"
-# DATE_FILTER = "2024-12-31"
+# SQL aggregate used for each accepted aggregation_function value.
+AGGREGATION_SQL = {'sum': 'SUM', 'mean': 'AVG', 'count': 'COUNT'}
 
-# Set a maximum number of files to download. Set to None to download all matching files.
-MAX_DOWNLOADS = None # Example: 5 to test with 5 files
 
-# --- Data Processing Settings ---
-# Names of the layers and columns for the join operation.
-SPATIAL_LAYER = 'PONNOT'
-SPATIAL_KEY = 'COD_ID'      # Key in the PONNOT spatial layer
-CONSUMER_KEY = 'PN_CON'     # Key in the UC_tab tables
-CONSUMER_LAYERS = ['UCAT_tab', 'UCMT_tab', 'UCBT_tab']
+@dataclass(frozen=True, slots=True)
+class Config:
+    """ Immutable container for every pipeline setting, built from config.toml by load(). """
+    company_filter: str
+    date_filter: str
+    max_downloads: Optional[int]
+    spatial_layer: str
+    spatial_key: str
+    consumer_key: str
+    consumer_layers: tuple[str, ...]  # Tuple for ordered iteration; use consumer_layers_set for `in` checks.
+    aggregation_column: str
+    aggregation_function: str
+    grid_cell_size: float
+    grid_cell_units: str
+    target_crs_epsg: str
+    download_dir: str
+    extract_dir: str
+    output_filename: str
+    reproject_to_wgs84: bool
+    fast_writes: bool
+    # Derived values, computed once by load() instead of on every use.
+    aggregation_sql: str = field(init=False, repr=False, compare=False)
+    consumer_layers_set: frozenset[str] = field(init=False, repr=False, compare=False)
 
-# --- Thematic Map Settings (NEW) ---
-# The column from the data to be aggregated and displayed on the map.
-# This value is used if AGGREGATION_FUNCTION is 'sum' or 'mean'.
-# Common options: 'ENE_TOT' (total energy), 'DEM' (demand/installed capacity).
-AGGREGATION_COLUMN = 'ENE_TOT'
+    def __post_init__(self):
+        """ Validate the settings once, so a bad config fails when it is loaded instead of mid-pipeline. """
+        agg_func = self.aggregation_function.lower()
+        if agg_func not in AGGREGATION_SQL:
+            raise ValueError(f"Invalid aggregation_function '{self.aggregation_function}'. Valid options are: 'sum', 'mean', or 'count'.")
+        # grid_cell_units and target_crs_epsg are only checked here: the pipeline does not read either yet,
+        # since grids are always sized in kilometers and built in EPSG:4326.
+        if self.grid_cell_units not in ('meters', 'degrees'):
+            raise ValueError(f"Invalid grid_cell_units '{self.grid_cell_units}'. Valid options are: 'meters' or 'degrees'.")
+        try:
+            pyproj.CRS.from_user_input(self.target_crs_epsg)
+        except pyproj.exceptions.CRSError as e:
+            raise ValueError(f"Invalid target_crs_epsg '{self.target_crs_epsg}': {e}") from e
+        if self.grid_cell_size <= 0:
+            raise ValueError(f"grid_cell_size must be positive, got {self.grid_cell_size}.")
+        if self.max_downloads is not None and self.max_downloads < 1:
+            raise ValueError(f"max_downloads must be None or a positive integer, got {self.max_downloads}.")
+        object.__setattr__(self, 'aggregation_function', agg_func)
+        object.__setattr__(self, 'aggregation_sql', AGGREGATION_SQL[agg_func])
+        object.__setattr__(self, 'consumer_layers', tuple(self.consumer_layers))
+        object.__setattr__(self, 'consumer_layers_set', frozenset(self.consumer_layers))
 
-# The function used to aggregate the data within each grid cell.
-# Valid options are: 'sum', 'mean', or 'count'.
-# If you use 'count', the map will show the number of consumer units per cell,
-# and the AGGREGATION_COLUMN value will be ignored.
-AGGREGATION_FUNCTION = 'sum'
 
-# --- Grid Map Parameters ---
-# The size of each square grid cell for the aggregation map.
-# GRID_CELL_SIZE = 10  # 10 = 10km x 10km grid
-# GRID_CELL_SIZE = 5  # 5 = 5km x 5km grid
-# GRID_CELL_SIZE = 3  # 3 = 3km x 3km grid
-GRID_CELL_SIZE = 1  # 1 = 1km x 1km grid
+CONFIG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'config.toml')
 
-# The units for the grid cell size ('meters' or 'degrees'). 'meters' is recommended.
-GRID_CELL_UNITS = 'meters'
 
-# The target EPSG code for a projected coordinate system (required for 'meters').
-# Example: 'EPSG:31983' for SIRGAS 2000 / UTM Zone 23S (covers a large part of Brazil).
-TARGET_CRS_EPSG = 'EPSG:31983'
+@functools.cache
+def load() -> Config:
+    """ Read config.toml on first use and return the validated Config. """
+    with open(CONFIG_PATH, 'rb') as f:
+        settings = tomllib.load(f)
+    # TOML has no null type: 0 means "no download limit".
+    settings['max_downloads'] = settings.get('max_downloads') or None
+    return Config(**settings)
 
-# --- Folder and File Settings ---
-# Names of the local directories for storing data.
-DOWNLOAD_DIR = "data/downloads"
-EXTRACT_DIR = "data/extracted"
 
-# Name of the final interactive map file.
-OUTPUT_FILENAME = "output/aneel_bdgd.html"
+@functools.lru_cache(maxsize=None)
+def compile_filter(value: str) -> Optional[re.Pattern]:
+    """ Return a case-insensitive substring matcher for a filter string, or None if the filter is empty. """
+    return re.compile(re.escape(value), re.IGNORECASE) if value else None
 
-# --- GEOMETRY SETTINGS ---
-# Set to True to reproject all incoming geometries to WGS84 (EPSG:4326).
-# Set to False to keep the original CRS from the source files.
-# WARNING: Setting to False is only recommended if all your source files share the exact same CRS.
-REPROJECT_TO_WGS84 = False
\ No newline at end of file
+
+def __getattr__(name):
+    # Keep `config.CONFIG` working while only touching the filesystem on first access.
+    if name == 'CONFIG':
+        return load()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
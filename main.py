@@ -1,20 +1,30 @@
 import os
 import sys
+import functools
+import hashlib
+import json
 import requests
+import urllib3
+import shutil
+import tempfile
 import zipfile
 import logging
 import pandas as pd
 import geopandas as gpd
-import fiona
+import pyogrio
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
 import warnings
 import numpy as np
 import sqlalchemy
 from sqlalchemy import create_engine, text, event
-from shapely.geometry import Polygon
+import shapely
 import folium
 from tqdm import tqdm
 import time
 import argparse
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 import pyproj # <-- FIX: Add this import
 import branca.colormap as cm
 
@@ -26,30 +36,303 @@ logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(
 logger = logging.getLogger(__name__)
 warnings.filterwarnings('ignore', 'Normalized/laundered field name')
 
-def is_valid_geometry(geom):
-    """ Check if a geometry is valid and not empty. """
-    return geom is not None and not geom.is_empty and geom.is_valid
+# Number of features read from a GDB layer and inserted into SQLite per executemany call.
+BATCH_SIZE = 10_000
+# Concurrent dataset downloads, and the read size used while streaming each one to disk.
+DOWNLOAD_WORKERS = 8
+DOWNLOAD_CHUNK_SIZE = 1 << 20
+# Archives that inflate to more than this are extracted by several threads, each with its own handle on the zip.
+PARALLEL_EXTRACT_MIN_BYTES = 256 << 20
+EXTRACT_THREADS = 4
+# Seconds a saved copy of the ANEEL catalog stays valid before search_and_filter walks the API again.
+CATALOG_TTL_SECONDS = 24 * 60 * 60
+# Items per catalog API page, and how many pages are requested at once once the total is known.
+CATALOG_PAGE_SIZE = 100
+CATALOG_WORKERS = 4
+# Monthly energy columns summed into ENE_TOT; any missing from a source is treated as 0.
+ENE_COLUMNS = [f'ENE_{i:02d}' for i in range(1, 13)]
+# Decimal places kept in the map's GeoJSON coordinates.
+GEOJSON_DECIMALS = 6
+
+def gdb_root(name):
+    """ Return the '<...>.gdb' directory prefix of a zip entry name, or None if the entry is not inside a GDB. """
+    parts = name.split('/')
+    for i, part in enumerate(parts[:-1]):
+        if part.endswith('.gdb'): return '/'.join(parts[:i + 1])
+    return None
+
+def gdb_signature(gdb_path):
+    """ Return (newest file mtime, total bytes) of a GDB's files, or None if it is missing, to tell a rewritten GDB apart. """
+    # A directory's own mtime only moves when entries are added or removed, not when a .gdbtable is overwritten.
+    if not os.path.isdir(gdb_path): return None
+    stats = [os.stat(os.path.join(root, f)) for root, _, files in os.walk(gdb_path) for f in files]
+    return max((st.st_mtime for st in stats), default=0), sum(st.st_size for st in stats)
+
+# Characters zipfile replaces with '_' in entry names when extracting on Windows.
+WINDOWS_ILLEGAL_CHARS = str.maketrans(':<>|"?*', '_' * 7)
+
+def member_path(extract_path, name):
+    """ Return the path zipfile extracts the entry `name` to, after its own cleanup of drive letters, '.'/'..' parts and, on Windows, illegal characters. """
+    parts = [part for part in os.path.splitdrive(name.replace('/', os.sep))[1].split(os.sep) if part not in ('', os.curdir, os.pardir)]
+    if os.sep == '\\':
+        parts = [part for part in (part.translate(WINDOWS_ILLEGAL_CHARS).rstrip('.') for part in parts) if part]
+    return os.path.join(extract_path, *parts)
+
+def extract_members(zip_path, extract_path, members):
+    """ Extract the given entries through a fresh handle on the zip, so several threads can inflate one archive at once. """
+    with zipfile.ZipFile(zip_path, 'r') as z:
+        z.extractall(extract_path, members=members)
+
+def extract_archive(zip_path, extract_path):
+    """ Extract only the .gdb entries of a zip unless already extracted and return their directories; module-level so worker processes can run it. """
+    with zipfile.ZipFile(zip_path, 'r') as z:
+        # The central directory already lists every GDB, so neither extractall nor an os.walk is needed.
+        infos = [info for info in z.infolist() if gdb_root(info.filename)]
+    roots = {gdb_root(info.filename) for info in infos}
+    if not os.path.exists(extract_path):
+        if sum(info.file_size for info in infos) < PARALLEL_EXTRACT_MIN_BYTES:
+            extract_members(zip_path, extract_path, infos)
+        else:
+            # zlib releases the GIL while inflating; deal the entries largest-first so the threads get similar byte counts.
+            infos.sort(key=lambda info: info.file_size, reverse=True)
+            # Create the directory tree up front; zipfile's own check-then-mkdir would race between threads.
+            # The paths must be the ones zipfile will write to, or a sanitized name would still go through that race.
+            for folder in {member_path(extract_path, info.filename) if info.is_dir() else os.path.dirname(member_path(extract_path, info.filename)) for info in infos}:
+                os.makedirs(folder, exist_ok=True)
+            with ThreadPoolExecutor(max_workers=EXTRACT_THREADS) as pool:
+                for future in [pool.submit(extract_members, zip_path, extract_path, infos[i::EXTRACT_THREADS]) for i in range(EXTRACT_THREADS)]:
+                    future.result()
+    return [member_path(extract_path, root) for root in roots]
+
+# SQLite column type per pandas dtype of a pyogrio-read column. Narrow GDB fields (Int16, Boolean) keep INTEGER
+# affinity so they are stored as 1-2 byte varints rather than as text; SQLite REAL is always 8 bytes, so Float32
+# fields gain nothing from a cast.
+SQLITE_TYPES = {'int8': 'INTEGER', 'uint8': 'INTEGER', 'int16': 'INTEGER', 'int32': 'INTEGER', 'int64': 'INTEGER',
+                'bool': 'INTEGER', 'float32': 'REAL', 'float64': 'REAL'}
+
+# Arrow type each SQLite column type is staged as in a worker's Parquet shard.
+ARROW_TYPES = {'INTEGER': pa.int64(), 'REAL': pa.float64(), 'TEXT': pa.string(), 'BLOB': pa.binary()}
+
+def sqlite_type(dtype):
+    """ Map a pandas dtype name such as 'int32' or 'float64' to a SQLite column type; anything else is stored as TEXT. """
+    return SQLITE_TYPES.get(dtype, 'TEXT')
+
+def build_corners_numpy(x0, y0, cell_size, out):
+    """ Fill `out` (N, 5, 2) with the closed ring of each square cell using NumPy broadcasting. """
+    x1, y1 = x0 + cell_size, y0 + cell_size
+    out[:] = np.stack([x0, y0, x1, y0, x1, y1, x0, y1, x0, y0], axis=1).reshape(-1, 5, 2)
+
+@functools.cache
+def corner_builder():
+    """ Return the grid corner builder, compiled with numba if it is installed and NumPy otherwise. """
+    # numba is optional and slow to import, so it is loaded on the first grid build rather than by every spawned worker.
+    try:
+        import numba
+    except ImportError:
+        return build_corners_numpy
+
+    @numba.njit(parallel=True, cache=True)
+    def build_corners(x0, y0, cell_size, out):
+        """ Fill `out` (N, 5, 2) with the closed ring of each square cell, spreading the cells across all cores. """
+        for i in numba.prange(x0.shape[0]):
+            x1, y1 = x0[i] + cell_size, y0[i] + cell_size
+            out[i, 0, 0] = x0[i]; out[i, 0, 1] = y0[i]
+            out[i, 1, 0] = x1; out[i, 1, 1] = y0[i]
+            out[i, 2, 0] = x1; out[i, 2, 1] = y1
+            out[i, 3, 0] = x0[i]; out[i, 3, 1] = y1
+            out[i, 4, 0] = x0[i]; out[i, 4, 1] = y0[i]
+    return build_corners
+
+def square_cells(x0, y0, cell_size):
+    """ Build square polygons from arrays of lower-left corners with one vectorized shapely.polygons call. """
+    x0 = np.ascontiguousarray(x0, dtype=np.float64)
+    y0 = np.ascontiguousarray(y0, dtype=np.float64)
+    # Rings are emitted already closed, so GEOS takes the buffer as-is instead of copying it to append the closing point.
+    coords = np.empty((len(x0), 5, 2), dtype=np.float64)
+    corner_builder()(x0, y0, float(cell_size), coords)
+    return shapely.polygons(coords)
+
+def build_grid_cells(xmin, ymin, xmax, ymax, cell_size):
+    """ Build the square cells covering the bounds. """
+    xs = np.arange(xmin, xmax, cell_size)
+    ys = np.arange(ymin, ymax, cell_size)
+    # 'ij' indexing keeps the x-major cell order of the original nested loops.
+    x0, y0 = (a.ravel() for a in np.meshgrid(xs, ys, indexing='ij'))
+    return square_cells(x0, y0, cell_size)
+
+def grid_center(xmin, ymin, ix, iy, cell_size):
+    """ Return the [lat, lon] mean of the cell centres straight from their grid indices, skipping a centroid pass. """
+    return [ymin + (np.mean(iy) + 0.5) * cell_size, xmin + (np.mean(ix) + 0.5) * cell_size]
+
+@functools.lru_cache(maxsize=None)
+def get_transformer(src_crs, dst_crs):
+    """ Build an always_xy pyproj Transformer once per (source, target) CRS pair. """
+    return pyproj.Transformer.from_crs(src_crs, dst_crs, always_xy=True)
+
+def reproject_geometries(geoms, transformer):
+    """ Reproject a shapely geometry array by transforming its flat coordinate buffer in a single batch. """
+    coords = shapely.get_coordinates(geoms)
+    x, y = transformer.transform(coords[:, 0], coords[:, 1])
+    return shapely.set_coordinates(geoms.copy(), np.column_stack([x, y]))
+
+def load_consumers(cfg, gdb_path):
+    """ Read every available consumer layer into one DataFrame plus its SQLite column types, or (None, None) if there are none. """
+    layers_present = cfg.consumer_layers_set.intersection(pyogrio.list_layers(gdb_path)[:, 0])
+    layers = [t for t in cfg.consumer_layers if t in layers_present]
+    if not layers: return None, None
+    tables = []
+    for layer in layers:
+        logger.info(f"  - Reading {layer} from {os.path.basename(gdb_path)}...")
+        tables.append(pyogrio.read_arrow(gdb_path, layer=layer, read_geometry=False, datetime_as_string=True)[1])
+    # Layers are stacked as Arrow buffers (missing columns become nulls) and converted to pandas once, after filtering.
+    table = pa.concat_tables(tables, promote_options='permissive')
+    # Null keys never match in SQL, but pandas would join NaN to NaN; categorical keys let the merge join on integer codes.
+    table = table.filter(pc.is_valid(table[cfg.consumer_key]))
+    for i, field in enumerate(table.schema):
+        # Repetitive text codes (classes, phases, ...) are also kept as dictionaries, so each distinct string is held once.
+        repetitive = (pa.types.is_string(field.type) or pa.types.is_large_string(field.type)) and pc.count_distinct(table[i]).as_py() * 2 < table.num_rows
+        if field.name == cfg.consumer_key or repetitive:
+            table = table.set_column(i, field.name, pc.dictionary_encode(table[i]))
+    consumers = table.to_pandas()
+    types = {col: sqlite_type(str(dtype.categories.dtype if isinstance(dtype, pd.CategoricalDtype) else dtype)) for col, dtype in consumers.dtypes.items()}
+    # Integers shrink to the narrowest type that holds them; floats stay float64, matching the 8-byte REALs they are stored as.
+    for col in consumers.select_dtypes('integer').columns:
+        consumers[col] = pd.to_numeric(consumers[col], downcast='integer')
+    return consumers, types
+
+def add_analytics(joined):
+    """ Add ENE_TOT, ENE_MED and DEM to a joined batch with whole-column NumPy arithmetic; missing or non-numeric inputs count as 0. """
+    ene = joined.reindex(columns=ENE_COLUMNS).apply(pd.to_numeric, errors='coerce').to_numpy(dtype=np.float64, na_value=0.0)
+    joined['ENE_TOT'] = ene.sum(axis=1)
+    joined['ENE_MED'] = joined['ENE_TOT'] / 12.0
+    joined['DEM'] = pd.to_numeric(joined['CAR_INST'], errors='coerce').fillna(0.0) if 'CAR_INST' in joined else 0.0
+    return joined
+
+def join_spatial_batches(cfg, base_crs, gdb_path, consumers):
+    """ Stream the spatial layer as Arrow batches and yield (SQLite column types, batch inner-joined with the consumers). """
+    with pyogrio.open_arrow(gdb_path, layer=cfg.spatial_layer, batch_size=BATCH_SIZE, use_pyarrow=True, datetime_as_string=True) as (meta, reader):
+        source_crs = pyproj.CRS(meta['crs'])
+        transformer = None
+        # Longitude/latitude are always WGS84; they come straight from the geometry when it is already in EPSG:4326.
+        to_wgs84 = get_transformer(source_crs.to_wkt(), 'EPSG:4326') if source_crs.to_epsg() != 4326 else None
+        if cfg.reproject_to_wgs84 and to_wgs84 is not None:
+            logger.info(f"  - Reprojecting from {source_crs.name} to EPSG:4326...")
+            transformer, to_wgs84 = to_wgs84, None
+        elif not cfg.reproject_to_wgs84 and source_crs != base_crs:
+            logger.warning(f"  - CRS mismatch! Expected {base_crs.to_string() if base_crs else None} but found {source_crs.name}.")
+
+        geometry_name = meta['geometry_name'] or 'wkb_geometry'
+        names = list(meta['fields'])
+        types = {name: sqlite_type(str(dtype)) for name, dtype in reader.schema.empty_table().select(names).to_pandas().dtypes.items()}
+        types.update(geometry='BLOB', longitude='REAL', latitude='REAL', ENE_TOT='REAL', ENE_MED='REAL', DEM='REAL')
+        # A name present in both layers (e.g. COD_ID) is taken from the spatial layer only.
+        consumers = consumers[[col for col in consumers.columns if col not in types or col == cfg.consumer_key]]
+        categories = consumers[cfg.consumer_key].cat.categories
+
+        logger.info(f"  - Streaming {cfg.spatial_layer} from {os.path.basename(gdb_path)}...")
+        for batch in reader:
+            # GDAL hands the geometries over as WKB; parse the whole batch in one call (missing ones become None).
+            geoms = shapely.from_wkb(batch.column(geometry_name).to_numpy(zero_copy_only=False))
+            # One vectorized GEOS call per predicate; missing geometries are neither valid nor kept.
+            valid = shapely.is_valid_input(geoms) & shapely.is_valid(geoms) & ~shapely.is_empty(geoms)
+            if not valid.any(): continue
+            geoms = geoms[valid]
+            if transformer is not None:
+                geoms = reproject_geometries(geoms, transformer)
+            spatial = batch.select(names).filter(valid).to_pandas()
+            # Serialize the batch to WKB in one call; the validity filter above guarantees it succeeds.
+            spatial['geometry'] = shapely.to_wkb(geoms)
+            # One batched PROJ call for the whole batch; non-point geometries get no coordinates, as ST_X/ST_Y gave them.
+            x, y = shapely.get_x(geoms), shapely.get_y(geoms)
+            spatial['longitude'], spatial['latitude'] = to_wgs84.transform(x, y) if to_wgs84 is not None else (x, y)
+            # Sharing the consumer categories turns the merge into an integer-code join; unmatched keys become NaN.
+            spatial[cfg.spatial_key] = pd.Categorical(spatial[cfg.spatial_key], categories=categories)
+            spatial = spatial[spatial[cfg.spatial_key].notna()]
+            yield types, add_analytics(spatial.merge(consumers, left_on=cfg.spatial_key, right_on=cfg.consumer_key, how='inner'))
+
+def read_gdb(cfg, base_crs_wkt, gdb_path, shard_path):
+    """ Worker process: join one GDB in pandas, stage it in a Parquet shard and return (name, status, [(column, type)], shard_path); status is 'ok', 'skipped' (nothing to join) or 'failed'. """
+    name = os.path.basename(gdb_path)
+    logger.info(f"\n--- Processing: {name} ---")
+    base_crs = pyproj.CRS(base_crs_wkt) if base_crs_wkt else None
+    columns, writer = None, None
+    try:
+        consumers, consumer_types = load_consumers(cfg, gdb_path)
+        if consumers is None:
+            logger.warning(f"  - No consumer layers found in {name}. Skipping."); return name, 'skipped', None, None
+        for spatial_types, joined in join_spatial_batches(cfg, base_crs, gdb_path, consumers):
+            if joined.empty: continue
+            if writer is None:
+                types = {**consumer_types, **spatial_types}
+                columns = [(col, types[col]) for col in joined.columns]
+                schema = pa.schema([(col, ARROW_TYPES.get(col_type, pa.string())) for col, col_type in columns])
+                # Staged uncompressed: the shard is read back once by the writer process and then deleted.
+                writer = pq.ParquetWriter(shard_path, schema, compression='none')
+            # Only one batch is ever held in memory, here or in the process that inserts the shard.
+            writer.write_table(pa.Table.from_pandas(joined, preserve_index=False).cast(writer.schema))
+        if writer is None:
+            logger.warning(f"  - No valid geometries with matching consumers in {name}. Skipping."); return name, 'skipped', None, None
+    except Exception as e:
+        logger.error(f"  - FAILED to process {name}. Error: {e}"); columns = None
+    finally:
+        if writer is not None: writer.close()
+    if columns is None:
+        # Never hand a partial shard to the writer process.
+        if os.path.exists(shard_path): os.remove(shard_path)
+        return name, 'failed', None, None
+    return name, 'ok', columns, shard_path
 
 class ANEEL_Pipeline:
     def __init__(self):
+        self.config = config.CONFIG
         self.session = requests.Session()
+        # Failed or throttled catalog calls are retried with exponential backoff by the adapter itself.
+        retry = urllib3.util.Retry(total=3, backoff_factor=0.5, status_forcelist=(429, 500, 502, 503, 504))
+        self.session.mount('https://', requests.adapters.HTTPAdapter(max_retries=retry, pool_maxsize=CATALOG_WORKERS))
+        self._http = urllib3.PoolManager(maxsize=DOWNLOAD_WORKERS)
         self.api_base = "https://dadosabertos-aneel.opendata.arcgis.com/api/search/v1/collections/dataset/items"
-        self.db_path = os.path.join(config.EXTRACT_DIR, 'aneel_data.db')
+        self.db_path = os.path.join(self.config.extract_dir, 'aneel_data.db')
+        self.catalog_path = os.path.join(self.config.download_dir, 'catalog.json')
         self.engine = None
         self.base_crs = None
+        self._base_srid = None
         self.spatialite_path = None
-        os.makedirs(config.DOWNLOAD_DIR, exist_ok=True)
-        os.makedirs(config.EXTRACT_DIR, exist_ok=True)
+        os.makedirs(self.config.download_dir, exist_ok=True)
+        os.makedirs(self.config.extract_dir, exist_ok=True)
+
+    def _set_base_crs(self, crs):
+        """ Record the pipeline CRS and resolve its EPSG code once, instead of re-parsing it per query. """
+        self.base_crs = crs
+        self._base_srid = pyproj.CRS(crs).to_epsg() if crs is not None else None
 
     def _load_spatialite(self, dbapi_conn, connection_record):
         if self.spatialite_path:
             dbapi_conn.enable_load_extension(True)
             dbapi_conn.load_extension(self.spatialite_path)
+        # Tune every connection for bulk loads: WAL journaling, in-memory temp tables, a 512 MiB page cache and memory-mapped reads.
+        # fast_writes keeps the rollback journal in RAM and skips fsyncs, so every page reaches the file once while a failed
+        # GDB still rolls back cleanly; only a crash or power loss mid-load can corrupt the database.
+        cursor = dbapi_conn.cursor()
+        cursor.execute(f"PRAGMA journal_mode={'MEMORY' if self.config.fast_writes else 'WAL'};")
+        cursor.execute(f"PRAGMA synchronous={'OFF' if self.config.fast_writes else 'NORMAL'};")
+        cursor.execute("PRAGMA temp_store=MEMORY;")
+        cursor.execute("PRAGMA cache_size=-524288;")
+        cursor.execute("PRAGMA mmap_size=30000000000;")
+        cursor.close()
 
     def _initialize_database(self):
         if os.path.exists(self.db_path):
             os.remove(self.db_path)
             logger.info(f"Removed existing database at {self.db_path}")
+        for leftover in (f"{self.db_path}-wal", f"{self.db_path}-shm"):
+            if os.path.exists(leftover): os.remove(leftover)
+        self._open_database()
+        with self.engine.connect() as conn:
+            conn.execute(text("SELECT InitSpatialMetaData(1);"))
+            logger.info("Database initialized with SpatiaLite metadata tables.")
+
+    def _open_database(self):
+        """ Locate SpatiaLite and point the engine at db_path, loading the extension on every new connection. """
         possible_paths = ['mod_spatialite', '/usr/lib/x86_64-linux-gnu/mod_spatialite.so', '/usr/local/lib/mod_spatialite.so']
         temp_engine = create_engine(f'sqlite:///')
         for path in possible_paths:
@@ -67,249 +350,318 @@ class ANEEL_Pipeline:
             sys.exit(1)
         self.engine = create_engine(f'sqlite:///{self.db_path}')
         event.listen(self.engine, "connect", self._load_spatialite)
-        with self.engine.connect() as conn:
-            conn.execute(text("SELECT InitSpatialMetaData(1);"))
-            logger.info("Database initialized with SpatiaLite metadata tables.")
 
-    def search_and_filter(self, company_filter, date_filter):
+    def _load_cache_key(self, gdb_paths):
+        """ Key a database build by the GDB set and the settings that shape processed_data (not the map settings). """
+        cfg = self.config
+        settings = (cfg.spatial_layer, cfg.spatial_key, cfg.consumer_key, cfg.consumer_layers, cfg.reproject_to_wgs84)
+        gdbs = sorted((path, gdb_signature(path)) for path in gdb_paths)
+        return hashlib.sha1(json.dumps([gdbs, settings]).encode()).hexdigest()
+
+    def _reuse_database(self, cache_key):
+        """ Reopen the database a previous run built from the same inputs and return True, or False if it must be rebuilt. """
+        if not os.path.exists(self.db_path): return False
+        self._open_database()
+        try:
+            with self.engine.connect() as conn:
+                row = conn.execute(text("SELECT cache_key, base_crs FROM pipeline_cache;")).fetchone()
+        except sqlalchemy.exc.DatabaseError as e:
+            # No cache table, or a file left corrupt by a crash: either way the database is rebuilt from scratch.
+            logger.debug(f"Cannot reuse database at {self.db_path}: {e}"); row = None
+        self.engine.dispose()  # Release the file, so _initialize_database can delete it on Windows.
+        if row is None or row[0] != cache_key: return False
+        self._set_base_crs(row[1])
+        logger.info(f"Reusing database at {self.db_path}, built from the same GDBs and settings.")
+        return True
+
+    def _fetch_catalog_page(self, startindex):
+        """ Return one page of File Geodatabase items as the API's JSON; raises once the adapter's retries are spent. """
+        params = {'type': "File Geodatabase", 'limit': CATALOG_PAGE_SIZE, 'startindex': startindex}
+        response = self.session.get(self.api_base, params=params, timeout=30)
+        response.raise_for_status()
+        return response.json()
+
+    def _fetch_catalog(self):
+        """ Return every File Geodatabase item of the ANEEL catalog, from catalog.json while it is younger than CATALOG_TTL_SECONDS. """
+        if os.path.exists(self.catalog_path) and time.time() - os.path.getmtime(self.catalog_path) < CATALOG_TTL_SECONDS:
+            logger.info(f"Using the dataset catalog saved at {self.catalog_path}...")
+            try:
+                with open(self.catalog_path, encoding='utf-8') as f:
+                    return json.load(f)
+            except ValueError as e:
+                logger.warning(f"Saved catalog is unreadable, searching the API again. Error: {e}")
         logger.info("Searching for all File Geodatabase datasets...")
-        all_features = []
-        startindex = 1
-        max_retries = 3
-        while True:
-            params = {'type': "File Geodatabase", 'limit': 100, 'startindex': startindex}
-            response = None
-            for attempt in range(max_retries):
-                try:
-                    response = self.session.get(self.api_base, params=params, timeout=30)
-                    response.raise_for_status()
-                    break
-                except requests.exceptions.RequestException as e:
-                    logger.warning(f"API request failed on attempt {attempt + 1}/{max_retries}. Retrying... Error: {e}")
-                    time.sleep(2)
-            if response is None:
-                logger.error("API requests failed after multiple retries. Aborting search.")
-                return []
-            data = response.json()
-            features = data.get('features', [])
-            if not features: break
-            all_features.extend(features)
-            if len(features) < 100: break
-            startindex += 100
-            time.sleep(0.5)
+        try:
+            first_page = self._fetch_catalog_page(1)
+            all_features = first_page.get('features', [])
+            total = first_page.get('numberMatched')
+            if total is not None:
+                # The first page reports the catalog size, so every remaining page can be requested concurrently.
+                start_indices = range(1 + CATALOG_PAGE_SIZE, total + 1, CATALOG_PAGE_SIZE)
+                with ThreadPoolExecutor(max_workers=CATALOG_WORKERS) as page_pool:
+                    for page in page_pool.map(self._fetch_catalog_page, start_indices):
+                        all_features.extend(page.get('features', []))
+            else:
+                # Without a total, keep walking until a short page, one request at a time.
+                features = all_features
+                while len(features) == CATALOG_PAGE_SIZE:
+                    features = self._fetch_catalog_page(1 + len(all_features)).get('features', [])
+                    all_features.extend(features)
+        except requests.exceptions.RequestException as e:
+            logger.error(f"API requests failed after multiple retries. Aborting search. Error: {e}")
+            return None
+        # Only a complete walk is saved, so a failed search is retried on the next run. It is written to a temporary
+        # file and swapped in, so an interrupted write never leaves a truncated catalog.json behind.
+        fd, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=self.config.download_dir)
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump(all_features, f)
+            os.replace(tmp_path, self.catalog_path)
+        except BaseException:
+            os.remove(tmp_path); raise
+        return all_features
+
+    def search_and_filter(self, company_filter, date_filter):
+        all_features = self._fetch_catalog()
+        if all_features is None: return []
         logger.info(f"Found {len(all_features)} total datasets from API. Applying filters...")
         filtered_features = []
-        company_upper = company_filter.upper() if company_filter else ""
-        date_upper = date_filter.upper() if date_filter else ""
+        company_re = config.compile_filter(company_filter)
+        date_re = config.compile_filter(date_filter)
         for feature in all_features:
             if not feature.get('id'): continue
             props = feature.get('properties', {})
-            if company_upper:
-                searchable_content = " ".join([props.get('title', ''), props.get('name', ''), " ".join(props.get('tags', []))]).upper()
-                if company_upper not in searchable_content: continue
-            if date_upper:
-                if date_upper not in props.get('name', '').upper(): continue
+            if company_re:
+                searchable_content = " ".join([props.get('title', ''), props.get('name', ''), " ".join(props.get('tags', []))])
+                if not company_re.search(searchable_content): continue
+            if date_re:
+                if not date_re.search(props.get('name', '')): continue
             filtered_features.append(feature)
         logger.info(f"Found {len(filtered_features)} datasets matching your criteria after filtering.")
         return filtered_features
 
+    def _download_feature(self, i, total, feature):
+        """ Download one dataset zip unless it is already on disk; return (filename, zip_path), or None on failure. """
+        props = feature['properties']; dataset_id = feature.get('id')
+        file_url = f"https://www.arcgis.com/sharing/rest/content/items/{dataset_id}/data"
+        filename = "".join(c for c in props.get('name', f"{dataset_id}.zip") if c.isalnum() or c in ('-', '_', '.'))
+        if not filename.endswith('.zip'): filename += '.zip'
+        zip_path = os.path.join(self.config.download_dir, filename)
+        if os.path.exists(zip_path):
+            logger.info(f"File {filename} already exists, skipping download."); return filename, zip_path
+        logger.info(f"Downloading ({i}/{total}): {filename}")
+        try:
+            # urllib3 reuses pooled connections across the download threads and copyfileobj moves large blocks per syscall.
+            # decode_content undoes any gzip transfer encoding in read() itself, so what lands on disk is the zip.
+            r = self._http.request('GET', file_url, preload_content=False, decode_content=True)
+            try:
+                if r.status >= 400: raise urllib3.exceptions.HTTPError(f"{r.status} Error for url: {file_url}")
+                total_size = int(r.headers.get('content-length', 0))
+                with open(zip_path, 'wb') as f, tqdm.wrapattr(f, 'write', total=total_size, desc=filename) as out:
+                    shutil.copyfileobj(r, out, length=DOWNLOAD_CHUNK_SIZE)
+            finally:
+                r.release_conn()
+        except Exception as e:
+            logger.error(f"Failed to download {filename}. Error: {e}")
+            # Never leave a truncated zip behind: it would be mistaken for a finished download on the next run.
+            if os.path.exists(zip_path): os.remove(zip_path)
+            return None
+        return filename, zip_path
+
     def download_and_extract_from_features(self, features):
         extracted_gdb_paths = []
-        for i, feature in enumerate(features, 1):
-            props = feature['properties']; dataset_id = feature.get('id')
-            file_url = f"https://www.arcgis.com/sharing/rest/content/items/{dataset_id}/data"
-            filename = "".join(c for c in props.get('name', f"{dataset_id}.zip") if c.isalnum() or c in ('-', '_', '.'))
-            if not filename.endswith('.zip'): filename += '.zip'
-            zip_path = os.path.join(config.DOWNLOAD_DIR, filename)
-            if not os.path.exists(zip_path):
-                logger.info(f"Downloading ({i}/{len(features)}): {filename}")
-                try:
-                    r = self.session.get(file_url, stream=True); r.raise_for_status()
-                    total_size = int(r.headers.get('content-length', 0))
-                    with open(zip_path, 'wb') as f, tqdm(total=total_size, unit='B', unit_scale=True, desc=filename) as pbar:
-                        for chunk in r.iter_content(chunk_size=8192):
-                            if chunk: f.write(chunk); pbar.update(len(chunk))
-                except Exception as e: logger.error(f"Failed to download {filename}. Error: {e}"); continue
-            else: logger.info(f"File {filename} already exists, skipping download.")
-            extract_path = os.path.join(config.EXTRACT_DIR, os.path.splitext(filename)[0])
-            if not os.path.exists(extract_path):
-                logger.info(f"Extracting {filename}...");
+        # Downloads are IO-bound and run on threads; extraction is CPU-bound and runs on processes.
+        # Each archive is handed to the extractor as soon as its download finishes.
+        with ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS) as download_pool, ProcessPoolExecutor() as extract_pool:
+            downloads = [download_pool.submit(self._download_feature, i, len(features), feature) for i, feature in enumerate(features, 1)]
+            extractions = {}
+            for download in as_completed(downloads):
+                if (result := download.result()) is None: continue
+                filename, zip_path = result
+                extract_path = os.path.join(self.config.extract_dir, os.path.splitext(filename)[0])
+                if not os.path.exists(extract_path): logger.info(f"Extracting {filename}...")
+                extractions[extract_pool.submit(extract_archive, zip_path, extract_path)] = filename
+            for extraction in as_completed(extractions):
                 try:
-                    with zipfile.ZipFile(zip_path, 'r') as z: z.extractall(extract_path)
-                except Exception as e: logger.error(f"Failed to extract {filename}. Error: {e}"); continue
-            for root, dirs, _ in os.walk(extract_path):
-                for d in dirs:
-                    if d.endswith('.gdb'): extracted_gdb_paths.append(os.path.join(root, d))
+                    extracted_gdb_paths.extend(extraction.result())
+                except Exception as e: logger.error(f"Failed to extract {extractions[extraction]}. Error: {e}")
         logger.info(f"Download and extraction complete. Found {len(extracted_gdb_paths)} GDBs.")
         return list(set(extracted_gdb_paths))
 
+    def _detect_base_crs(self, gdb_paths):
+        """ Return the CRS of the first readable spatial layer, so every worker compares against the same base. """
+        for gdb_path in gdb_paths:
+            try:
+                return pyogrio.read_info(gdb_path, layer=self.config.spatial_layer)['crs']
+            except Exception as e:
+                logger.debug(f"Could not read CRS from {gdb_path}: {e}")
+        return None
+
+    def _create_processed_table(self, cursor, columns):
+        """ Create processed_data from the first GDB's columns, ENE_TOT/ENE_MED/DEM included, plus any missing inputs. """
+        definitions = [f'"{col}" {col_type}' for col, col_type in columns]
+        names = {col for col, _ in columns}
+        # Inputs missing from the first source still get a column, as the old ALTER TABLE ... DEFAULT 0 did.
+        definitions += [f'"{col}" REAL DEFAULT 0' for col in ENE_COLUMNS if col not in names]
+        if 'CAR_INST' not in names: definitions.append('"CAR_INST" REAL')
+        cursor.execute(f"CREATE TABLE processed_data ({', '.join(definitions)});")
+
+    def _write_gdb(self, raw_conn, name, columns, shard_path):
+        """ Insert one GDB's staged Parquet shard into processed_data batch by batch and return 'ok', or 'failed' after a rollback. """
+        cursor = raw_conn.cursor()
+        try:
+            existing_columns = [row[1] for row in cursor.execute("PRAGMA table_info(processed_data);")]
+            if not existing_columns:
+                self._create_processed_table(cursor, columns)
+            else:
+                # Union the schemas across GDBs, as pd.concat would; adding a NULL column does not rewrite the table.
+                for col, col_type in columns:
+                    if col not in existing_columns: cursor.execute(f'ALTER TABLE processed_data ADD COLUMN "{col}" {col_type};')
+
+            quoted_names = ", ".join(f'"{col}"' for col, _ in columns)
+            insert_sql = f"INSERT INTO processed_data ({quoted_names}) VALUES ({', '.join('?' * len(columns))});"
+
+            logger.info(f"  - Writing joined records of {name}...")
+            for batch in pq.ParquetFile(shard_path).iter_batches(batch_size=BATCH_SIZE):
+                # Arrow nulls come back as None, which SQLite binds as NULL.
+                cursor.executemany(insert_sql, zip(*(column.to_pylist() for column in batch.columns)))
+            raw_conn.commit()
+            total_records = cursor.execute("SELECT count(*) FROM processed_data").fetchone()[0]
+            logger.info(f"  - Successfully joined {name}. Total records now: {total_records}")
+            return 'ok'
+        except Exception as e:
+            raw_conn.rollback(); logger.error(f"  - FAILED to write {name} to DB. Error: {e}"); return 'failed'
+
     def load_and_union_data(self, gdb_paths):
         logger.info("\n--- Loading and Unioning Data with Disk-Based SQLite/SpatiaLite ---")
+        cache_key = self._load_cache_key(gdb_paths)
+        if self._reuse_database(cache_key): return self
         self._initialize_database()
         
-        data_was_inserted = False
-        
-        if config.REPROJECT_TO_WGS84:
-            self.base_crs = 'EPSG:4326'
+        if self.config.reproject_to_wgs84:
+            self._set_base_crs('EPSG:4326')
             logger.info(f"Configuration set to reproject all geometries to CRS: {self.base_crs}")
         else:
-            self.base_crs = None
             logger.info("Configuration set to use original CRS from source files.")
-
-        def to_wkb_safe(geom):
-            if not is_valid_geometry(geom): return None
-            try: return geom.wkb
-            except Exception: return None
-
-        for gdb_path in gdb_paths:
-            logger.info(f"\n--- Processing: {os.path.basename(gdb_path)} ---")
-            try:
-                with fiona.open(gdb_path, 'r', layer=config.SPATIAL_LAYER) as source:
-                    if self.base_crs is None and not config.REPROJECT_TO_WGS84:
-                        self.base_crs = source.crs
-                        logger.info(f"Base CRS for pipeline established as: {str(self.base_crs)}")
-
-                    spatial_gdf = gpd.GeoDataFrame.from_features(source, crs=source.crs)
-                    spatial_gdf = spatial_gdf[spatial_gdf['geometry'].apply(is_valid_geometry)]
-                    if spatial_gdf.empty: logger.warning("  - No valid geometries in source. Skipping."); continue
-
-                    if config.REPROJECT_TO_WGS84 and spatial_gdf.crs.to_epsg() != 4326:
-                        logger.info(f"  - Reprojecting from {spatial_gdf.crs.name} to EPSG:4326...")
-                        spatial_gdf = spatial_gdf.to_crs('EPSG:4326')
-                    elif not config.REPROJECT_TO_WGS84 and spatial_gdf.crs != self.base_crs:
-                        logger.warning(f"  - CRS mismatch! Expected {str(self.base_crs)} but found {spatial_gdf.crs.name}.")
-
-                    spatial_gdf['geometry'] = spatial_gdf['geometry'].apply(to_wkb_safe)
-                    spatial_gdf.dropna(subset=['geometry'], inplace=True)
-                    if spatial_gdf.empty: logger.warning("  - No valid geometries after conversion. Skipping."); continue
-                    spatial_gdf.to_sql('spatial_temp', self.engine, if_exists='replace', index=False, dtype={'geometry': sqlalchemy.types.BLOB})
-
-                consumer_dfs = [gpd.read_file(gdb_path, layer=t) for t in config.CONSUMER_LAYERS if t in fiona.listlayers(gdb_path)]
-                if not consumer_dfs: logger.warning("  - No consumer layers found. Skipping."); continue
-                consumer_df = pd.concat(consumer_dfs, ignore_index=True)
-                consumer_df.to_sql('consumer_temp', self.engine, if_exists='replace', index=False)
-
-                with self.engine.connect() as conn:
-                    trans = conn.begin()
+            # Fixed before the workers start, so they all check for mismatches against the same CRS.
+            self._set_base_crs(self._detect_base_crs(gdb_paths))
+            logger.info(f"Base CRS for pipeline established as: {str(self.base_crs)}")
+
+        # GDAL parsing, GEOS validity, WKB serialization and the key join run in worker processes, one GDB each;
+        # this process stays the only SQLite writer and inserts each GDB's joined rows as soon as its worker finishes.
+        base_crs_wkt = pyproj.CRS(self.base_crs).to_wkt() if self.base_crs is not None else None
+        statuses = []
+        raw_conn = self.engine.raw_connection()
+        try:
+            # Workers hand their joins over as Parquet shards on disk, so neither side holds a whole GDB in memory.
+            with tempfile.TemporaryDirectory(dir=self.config.extract_dir) as shard_dir, \
+                    ProcessPoolExecutor(max_workers=min(len(gdb_paths), os.cpu_count() or 1)) as reader_pool:
+                readers = {reader_pool.submit(read_gdb, self.config, base_crs_wkt, gdb_path, os.path.join(shard_dir, f"{i}.parquet")): gdb_path
+                           for i, gdb_path in enumerate(gdb_paths)}
+                for reader in as_completed(readers):
                     try:
-                        logger.info("  - Creating indexes on temporary tables for faster joins...")
-                        conn.execute(text(f'CREATE INDEX idx_spatial_key ON spatial_temp("{config.SPATIAL_KEY}");'))
-                        conn.execute(text(f'CREATE INDEX idx_consumer_key ON consumer_temp("{config.CONSUMER_KEY}");'))
-
-                        inspector = sqlalchemy.inspect(self.engine)
-                        if not inspector.has_table("processed_data"):
-                            join_query = f"""CREATE TABLE processed_data AS SELECT s.*, c.* FROM spatial_temp AS s INNER JOIN consumer_temp AS c ON s."{config.SPATIAL_KEY}" = c."{config.CONSUMER_KEY}";"""
-                        else:
-                            join_query = f"""INSERT INTO processed_data SELECT s.*, c.* FROM spatial_temp AS s INNER JOIN consumer_temp AS c ON s."{config.SPATIAL_KEY}" = c."{config.CONSUMER_KEY}";"""
-                        
-                        logger.info("  - Performing indexed join...")
-                        conn.execute(text(join_query))
-                        trans.commit()
-                        data_was_inserted = True
-                        count_query = "SELECT count(*) FROM processed_data"
-                        total_records = conn.execute(text(count_query)).scalar()
-                        logger.info(f"  - Successfully joined data. Total records now: {total_records}")
+                        name, status, columns, shard_path = reader.result()
                     except Exception as e:
-                        trans.rollback(); logger.error(f"  - FAILED to join data in DB. Error: {e}")
-            except Exception as e:
-                logger.error(f"  - FAILED to process GDB file. Error: {e}")
-        
-        if not data_was_inserted:
-            logger.warning("\nNo data was loaded. Skipping spatial index creation."); return self
+                        # A worker killed by the OS breaks the pool, so this and every GDB still pending end up here.
+                        logger.error(f"  - FAILED to process {os.path.basename(readers[reader])}. Error: {e!r}"); statuses.append('failed'); continue
+                    if status == 'ok':
+                        status = self._write_gdb(raw_conn, name, columns, shard_path); os.remove(shard_path)
+                    statuses.append(status)
+        finally:
+            raw_conn.close()
+
+        if 'ok' not in statuses:
+            logger.warning("\nNo data was loaded. Skipping index creation."); return self
+        # A GDB that failed to read or write may load next time, so a database missing it must never be reused.
+        failures = statuses.count('failed')
+        if failures: logger.warning(f"\n{failures} GDB(s) failed to load; the database will be rebuilt on the next run.")
 
         with self.engine.connect() as conn:
-            logger.info("Creating spatial index and coordinate columns...")
+            logger.info("Creating key and spatial indexes...")
             try:
                 trans = conn.begin()
-                srid = pyproj.CRS(self.base_crs).to_epsg()
+                # Indexed once here, after every GDB is in, rather than maintained across the repeated inserts.
+                conn.execute(text(f'CREATE INDEX idx_processed_spatial_key ON processed_data("{self.config.spatial_key}");'))
+                srid = self._base_srid
                 conn.execute(text("SELECT DiscardGeometryColumn('processed_data', 'geom');"))
                 conn.execute(text(f"SELECT AddGeometryColumn('processed_data', 'geom', {srid}, 'POINT', 2)"))
                 conn.execute(text(f"UPDATE processed_data SET geom = GeomFromWKB(geometry, {srid})"))
                 conn.execute(text("SELECT CreateSpatialIndex('processed_data', 'geom')"))
-                
-                # --- NEW: Add and populate latitude and longitude columns ---
-                logger.info("  - Pre-calculating longitude and latitude columns...")
-                conn.execute(text("ALTER TABLE processed_data ADD COLUMN longitude REAL;"))
-                conn.execute(text("ALTER TABLE processed_data ADD COLUMN latitude REAL;"))
-                
-                # Determine the geometry to use for coordinate extraction (transform if necessary)
-                coord_geom = "Transform(geom, 4326)" if srid != 4326 else "geom"
-                
-                # Populate the new columns
-                conn.execute(text(f"UPDATE processed_data SET longitude = ST_X({coord_geom});"))
-                conn.execute(text(f"UPDATE processed_data SET latitude = ST_Y({coord_geom});"))
-
+                # Recorded last, in the same transaction, so only a fully built database is ever reused.
+                if not failures:
+                    conn.execute(text("CREATE TABLE pipeline_cache (cache_key TEXT, base_crs TEXT);"))
+                    conn.execute(text("INSERT INTO pipeline_cache VALUES (:key, :crs);"), {'key': cache_key, 'crs': self.base_crs})
                 trans.commit()
-                logger.info("Spatial index and coordinate columns created successfully.")
+                logger.info("Key and spatial indexes created successfully.")
             except Exception as e:
-                trans.rollback(); logger.error(f"FAILED to create spatial index/columns. Error: {e}")
+                trans.rollback(); logger.error(f"FAILED to create key/spatial indexes. Error: {e}")
         return self
 
     def process_analytics(self):
         if not self.engine: logger.warning("Skipping analytics: DB not available."); return self
-        logger.info("\n--- Executing analytics directly in the database ---")
-        ene_cols = [f'ENE_{str(i).zfill(2)}' for i in range(1, 13)]
+        logger.info("\n--- Summarizing analytics computed during the load ---")
+        # ENE_TOT, ENE_MED and DEM are computed by the reader workers before insertion; this only reports their totals.
         with self.engine.connect() as conn:
-            trans = conn.begin()
             try:
-                conn.execute(text("ALTER TABLE processed_data ADD COLUMN ENE_TOT REAL;"))
-                conn.execute(text("ALTER TABLE processed_data ADD COLUMN ENE_MED REAL;"))
-                conn.execute(text("ALTER TABLE processed_data ADD COLUMN DEM REAL;"))
-                table_info = pd.read_sql("PRAGMA table_info(processed_data);", conn)
-                existing_cols = table_info['name'].tolist()
-                for col in ene_cols:
-                    if col not in existing_cols:
-                        conn.execute(text(f"ALTER TABLE processed_data ADD COLUMN {col} REAL DEFAULT 0;"))
-                sum_expression = " + ".join([f"COALESCE(CAST({col} AS REAL), 0)" for col in ene_cols])
-                conn.execute(text(f"UPDATE processed_data SET ENE_TOT = {sum_expression};"))
-                conn.execute(text("UPDATE processed_data SET ENE_MED = ENE_TOT / 12.0;"))
-                conn.execute(text("UPDATE processed_data SET DEM = COALESCE(CAST(CAR_INST AS REAL), 0);"))
-                trans.commit()
-                logger.info("Analytics complete. Columns ENE_TOT, ENE_MED, DEM created.")
-            except Exception as e:
-                trans.rollback(); logger.error(f"Failed to process analytics in database. Error: {e}")
+                ene_tot, ene_med, dem = conn.execute(text("SELECT SUM(ENE_TOT), SUM(ENE_MED), SUM(DEM) FROM processed_data;")).fetchone()
+                logger.info(f"Analytics complete. Totals: ENE_TOT={ene_tot or 0:,.2f}, ENE_MED={ene_med or 0:,.2f}, DEM={dem or 0:,.2f}.")
+            except sqlalchemy.exc.OperationalError as e:
+                logger.error(f"Failed to summarize analytics in database. Error: {e}")
         return self
 
-    def generate_grid_map_v1(self, grid_cell_size_arg=None):
-        if not self.engine: 
-            logger.warning("Cannot generate map: DB not available."); return None
-        logger.info("\n--- Generating map using chunk-based grid aggregation ---")
-        grid_cell_size_km = grid_cell_size_arg if grid_cell_size_arg is not None else config.GRID_CELL_SIZE
-        agg_col = config.AGGREGATION_COLUMN
-        agg_func = config.AGGREGATION_FUNCTION.lower()
-        needs_transform = pyproj.CRS(self.base_crs).to_epsg() != 4326
+    def _query_coordinate_bounds(self):
+        """ Return (xmin, ymin, xmax, ymax) in WGS84 from the pre-calculated coordinate columns, or None. """
+        logger.info("Calculating grid bounds from coordinate columns...")
         with self.engine.connect() as conn:
-            bounds_query_geom = "Transform(geom, 4326)" if needs_transform else "geom"
-            query = text(f"SELECT Min(MbrMinX({bounds_query_geom})), Min(MbrMinY({bounds_query_geom})), Max(MbrMaxX({bounds_query_geom})), Max(MbrMaxY({bounds_query_geom})) FROM processed_data;")
+            query = text("SELECT MIN(longitude), MIN(latitude), MAX(longitude), MAX(latitude) FROM processed_data;")
             try:
                 xmin, ymin, xmax, ymax = conn.execute(query).fetchone()
             except sqlalchemy.exc.OperationalError as e:
-                logger.error(f"Could not calculate data bounds. Was the spatial index created correctly? Error: {e}"); return None
+                logger.error(f"Could not calculate data bounds. Are longitude/latitude columns missing? Error: {e}"); return None
         if not all((xmin, ymin, xmax, ymax)):
             logger.warning("Could not determine data bounds from database. Cannot generate map."); return None
-        grid_cell_size_deg = grid_cell_size_km / 111.32
-        logger.info(f"Generating grid ({grid_cell_size_km}km ≈ {grid_cell_size_deg:.4f} degrees)...")
-        grid_cells = [Polygon([(x0, y0), (x0 + grid_cell_size_deg, y0), (x0 + grid_cell_size_deg, y0 + grid_cell_size_deg), (x0, y0 + grid_cell_size_deg)]) for x0 in np.arange(xmin, xmax, grid_cell_size_deg) for y0 in np.arange(ymin, ymax, grid_cell_size_deg)]
-        grid_gdf = gpd.GeoDataFrame(grid_cells, columns=['geometry'], crs='EPSG:4326')
-        grid_gdf[agg_col] = 0; grid_gdf['point_count'] = 0
-        logger.info(f"Aggregating data for {len(grid_gdf)} grid cells...")
-        with self.engine.connect() as conn:
-            srid = pyproj.CRS(self.base_crs).to_epsg()
-            for i, cell in tqdm(grid_gdf.iterrows(), total=len(grid_gdf)):
-                cell_wkt = cell.geometry.wkt
-                st_contains_geom = f"Transform(GeomFromText('{cell_wkt}', 4326), {srid})" if needs_transform else f"GeomFromText('{cell_wkt}', 4326)"
-                query = text(f""" SELECT {agg_func.upper()}({agg_col}) as agg_val, COUNT(*) as p_count FROM processed_data WHERE ST_Contains({st_contains_geom}, geom); """)
-                result = conn.execute(query).fetchone()
-                agg_val, p_count = result if result else (0, 0)
-                if p_count > 0:
-                    grid_gdf.at[i, agg_col] = agg_val if agg_val is not None else 0
-                    grid_gdf.at[i, 'point_count'] = p_count
-        grid_with_data = grid_gdf[grid_gdf['point_count'] > 0].copy()
-        if grid_with_data.empty:
-            logger.warning("No data points fell within the grid. Cannot create map."); return None
-        map_center = [grid_with_data.geometry.centroid.y.mean(), grid_with_data.geometry.centroid.x.mean()]
+        return xmin, ymin, xmax, ymax
+
+    def _query_cell_aggregates(self, xmin, ymin, ymax, cell_size_deg, agg_col, agg_sql):
+        """ Bin every point into its grid cell with pure arithmetic and aggregate per cell in one query. """
+        # This query avoids all spatial operations and uses pure arithmetic for binning.
+        # Each point gets a single flat cell id (x-major, like build_grid_cells), so SQLite groups on one integer key.
+        # The bounds and cell size are bound as parameters; only the column and aggregate names are formatted in.
+        aggregation_query = f"""
+            SELECT
+                CAST(FLOOR((longitude - :xmin) / :cell_size) AS INTEGER) * :ny
+                    + CAST(FLOOR((latitude - :ymin) / :cell_size) AS INTEGER) as grid_id,
+                {agg_sql}("{agg_col}") AS {agg_col},
+                COUNT(*) as point_count
+            FROM
+                processed_data
+            WHERE
+                longitude IS NOT NULL AND latitude IS NOT NULL
+            GROUP BY
+                grid_id;
+        """
+        # Rows per grid column, counting the row that holds points lying exactly on ymax.
+        ny = int(np.floor((ymax - ymin) / cell_size_deg)) + 1
+        params = {'xmin': xmin, 'ymin': ymin, 'cell_size': cell_size_deg, 'ny': ny}
+        logger.info("Aggregation query:")
+        logger.info(aggregation_query)
+        logger.info(f"Query parameters: {params}")
+        agg_results_df = pd.read_sql(text(aggregation_query), self.engine, params=params)
+        agg_results_df['grid_x_index'], agg_results_df['grid_y_index'] = np.divmod(agg_results_df.pop('grid_id').to_numpy(), ny)
+        logger.info(f"Aggregation complete. Found data in {len(agg_results_df)} grid cells.")
+        return agg_results_df
+
+    def _render_grid_map(self, grid_with_data, map_center, extra_fields=None):
+        """ Draw aggregated cells as one styled GeoJson layer, emitting only the properties the tooltip shows. """
+        agg_col = self.config.aggregation_column
+        agg_func = self.config.aggregation_function
+        fields = {**(extra_fields or {}), agg_col: f'{agg_col}:', 'point_count': 'Point Count:'}
+        # Index columns and other leftovers would be serialized into every feature of the HTML for nothing.
+        grid_for_map = grid_with_data[[*fields, 'geometry']].copy()
+        # Six decimals (~0.1 m) is far below what a cell needs and keeps the coordinates short in the HTML.
+        grid_for_map.geometry = shapely.transform(grid_for_map.geometry.values, lambda coords: np.round(coords, GEOJSON_DECIMALS))
         m = folium.Map(location=map_center, zoom_start=6, tiles='CartoDB positron')
-        non_zero_data = grid_with_data[grid_with_data[agg_col] > 0]
+        non_zero_data = grid_for_map[grid_for_map[agg_col] > 0]
         min_val = non_zero_data[agg_col].min() if not non_zero_data.empty else 0
         max_val = non_zero_data[agg_col].max() if not non_zero_data.empty else 0
         if min_val == max_val: min_val = max_val * 0.9 if max_val > 0 else 0
@@ -321,74 +673,102 @@ class ANEEL_Pipeline:
                 return {'fillColor': colormap(value), 'color': 'black', 'weight': 0.5, 'fillOpacity': 0.7}
             else:
                 return {'fillColor': '#D3D3D3', 'color': 'black', 'weight': 0.5, 'fillOpacity': 0.5}
-        folium.GeoJson(grid_with_data, style_function=style_function, name='Aggregated Data',
-            tooltip=folium.GeoJsonTooltip(fields=[agg_col, 'point_count'], aliases=[f'{agg_col}:', 'Point Count:'], localize=True)
+        folium.GeoJson(grid_for_map, style_function=style_function, name='Aggregated Data',
+            tooltip=folium.GeoJsonTooltip(fields=list(fields), aliases=list(fields.values()), localize=True)
         ).add_to(m)
         colormap.add_to(m)
         folium.LayerControl().add_to(m)
         return m
 
+    def generate_grid_map_v1(self, grid_cell_size_arg=None):
+        if not self.engine: 
+            logger.warning("Cannot generate map: DB not available."); return None
+        logger.info("\n--- Generating map using arithmetic aggregation clipped to the full grid ---")
+        grid_cell_size_km = grid_cell_size_arg if grid_cell_size_arg is not None else self.config.grid_cell_size
+        agg_col = self.config.aggregation_column
+        agg_sql = self.config.aggregation_sql
+        bounds = self._query_coordinate_bounds()
+        if bounds is None: return None
+        xmin, ymin, xmax, ymax = bounds
+        grid_cell_size_deg = grid_cell_size_km / 111.32
+        logger.info(f"Aggregating data over a {grid_cell_size_km}km grid (≈ {grid_cell_size_deg:.4f} degrees)...")
+        agg_results_df = self._query_cell_aggregates(xmin, ymin, ymax, grid_cell_size_deg, agg_col, agg_sql)
+        # Only occupied cells are built, but they are clipped to the full grid's extent as before: cells that
+        # np.arange stops short of (points lying on xmax/ymax) stay off the map.
+        nx, ny = len(np.arange(xmin, xmax, grid_cell_size_deg)), len(np.arange(ymin, ymax, grid_cell_size_deg))
+        in_grid = (agg_results_df['grid_x_index'] < nx) & (agg_results_df['grid_y_index'] < ny)
+        agg_results_df = agg_results_df[in_grid].reset_index(drop=True)
+        ix = agg_results_df['grid_x_index'].to_numpy()
+        iy = agg_results_df['grid_y_index'].to_numpy()
+        geometries = square_cells(xmin + ix * grid_cell_size_deg, ymin + iy * grid_cell_size_deg, grid_cell_size_deg)
+        grid_with_data = gpd.GeoDataFrame(agg_results_df, geometry=geometries, crs='EPSG:4326')
+        grid_with_data[agg_col] = grid_with_data[agg_col].fillna(0)
+        if grid_with_data.empty:
+            logger.warning("No data points fell within the grid. Cannot create map."); return None
+        map_center = grid_center(xmin, ymin, grid_with_data['grid_x_index'], grid_with_data['grid_y_index'], grid_cell_size_deg)
+        return self._render_grid_map(grid_with_data, map_center)
+
     def generate_grid_map_v2_database(self, grid_cell_size_arg=None):
         if not self.engine:
             logger.warning("Cannot generate map: Database engine not available."); return None
         logger.info("\n--- Generating map using high-performance in-database aggregation ---")
-        grid_cell_size_km = grid_cell_size_arg if grid_cell_size_arg is not None else config.GRID_CELL_SIZE
-        agg_col = config.AGGREGATION_COLUMN
-        agg_func = config.AGGREGATION_FUNCTION.lower()
+        grid_cell_size_km = grid_cell_size_arg if grid_cell_size_arg is not None else self.config.grid_cell_size
+        agg_col = self.config.aggregation_column
+        agg_sql = self.config.aggregation_sql
         
-        # 1. Get data bounds from the database
-        with self.engine.connect() as conn:
-            srid = pyproj.CRS(self.base_crs).to_epsg()
-            needs_transform = srid != 4326
-            bounds_query_geom = f"Transform(geom, 4326)" if needs_transform else "geom"
-            query = text(f"SELECT Min(MbrMinX({bounds_query_geom})), Min(MbrMinY({bounds_query_geom})), Max(MbrMaxX({bounds_query_geom})), Max(MbrMaxY({bounds_query_geom})) FROM processed_data;")
-            try:
-                xmin, ymin, xmax, ymax = conn.execute(query).fetchone()
-            except sqlalchemy.exc.OperationalError as e:
-                logger.error(f"Could not calculate data bounds. Was the spatial index created correctly? Error: {e}"); return None
-
-        if not all((xmin, ymin, xmax, ymax)):
-            logger.warning("Could not determine data bounds from database. Cannot generate map."); return None
+        # 1. Get data bounds from the stored WGS84 coordinates; no per-row Transform/Mbr calls are needed.
+        bounds = self._query_coordinate_bounds()
+        if bounds is None: return None
+        xmin, ymin, xmax, ymax = bounds
 
         # 2. Create grid cells in Python
         grid_cell_size_deg = grid_cell_size_km / 111.32
         logger.info(f"Generating {grid_cell_size_km}km grid cells...")
-        grid_cells = [Polygon([(x0, y0), (x0 + grid_cell_size_deg, y0), (x0 + grid_cell_size_deg, y0 + grid_cell_size_deg), (x0, y0 + grid_cell_size_deg)]) for x0 in np.arange(xmin, xmax, grid_cell_size_deg) for y0 in np.arange(ymin, ymax, grid_cell_size_deg)]
-        grid_gdf = gpd.GeoDataFrame(grid_cells, columns=['geometry'], crs='EPSG:4326')
+        grid_gdf = gpd.GeoDataFrame(geometry=build_grid_cells(xmin, ymin, xmax, ymax, grid_cell_size_deg), crs='EPSG:4326')
         grid_gdf['grid_id'] = range(len(grid_gdf)) # Add a unique ID for joining
 
-        # 3. Upload grid to a temporary spatial table in the database
+        # 3. Upload the grid as plain bounding boxes; axis-aligned cells need no SpatiaLite geometry
         logger.info(f"Uploading {len(grid_gdf)} grid cells to the database for processing...")
-        grid_gdf['geometry_wkb'] = grid_gdf['geometry'].apply(lambda geom: geom.wkb)
-        grid_gdf.drop(columns='geometry').to_sql('grid_temp', self.engine, if_exists='replace', index=False)
+        bounds = shapely.bounds(grid_gdf.geometry.values)
+        grid_rows = list(zip(grid_gdf['grid_id'].tolist(), bounds[:, 0].tolist(), bounds[:, 2].tolist(), bounds[:, 1].tolist(), bounds[:, 3].tolist()))
 
         with self.engine.connect() as conn:
             trans = conn.begin()
             try:
-                conn.execute(text("SELECT DiscardGeometryColumn('grid_temp', 'geom');"))
-                conn.execute(text(f"SELECT AddGeometryColumn('grid_temp', 'geom', 4326, 'POLYGON', 2)"))
-                conn.execute(text(f"UPDATE grid_temp SET geom = GeomFromWKB(geometry_wkb, 4326)"))
-                conn.execute(text("SELECT CreateSpatialIndex('grid_temp', 'geom')"))
+                conn.execute(text("DROP TABLE IF EXISTS grid_temp;"))
+                conn.execute(text("CREATE TABLE grid_temp (grid_id INTEGER PRIMARY KEY, minX REAL, maxX REAL, minY REAL, maxY REAL);"))
+                # One executemany in the same transaction as the R*Tree build, instead of a DataFrame.to_sql round trip.
+                conn.exec_driver_sql("INSERT INTO grid_temp VALUES (?, ?, ?, ?, ?);", grid_rows)
+                # SQLite's native R*Tree answers rectangle queries in C, without SpatiaLite's GEOS call per pair.
+                # It only depends on the points, so it is built on first use and reused by every later render,
+                # whatever the grid size; a rebuilt database starts without one.
+                if conn.execute(text("SELECT 1 FROM sqlite_master WHERE name = 'points_rtree';")).first() is None:
+                    conn.execute(text("CREATE VIRTUAL TABLE points_rtree USING rtree(id, minX, maxX, minY, maxY);"))
+                    conn.execute(text("INSERT INTO points_rtree SELECT rowid, longitude, longitude, latitude, latitude FROM processed_data WHERE longitude IS NOT NULL AND latitude IS NOT NULL;"))
+                    logger.info("R*Tree index of point coordinates created.")
                 trans.commit()
-                logger.info("Spatial index created on temporary grid table.")
+                logger.info("Grid table uploaded.")
             except Exception as e:
-                trans.rollback(); logger.error(f"FAILED to create spatial grid table. Error: {e}"); return None
+                trans.rollback(); logger.error(f"FAILED to create grid table/point R*Tree index. Error: {e}"); return None
 
         # 4. Perform the entire aggregation with a single, powerful SQL query
-        logger.info("Performing high-performance spatial join and aggregation... (This may take a moment)")
-        
-        # The geometry that the points will be joined against
-        join_geom = f"Transform(g.geom, {srid})" if needs_transform else "g.geom"
+        logger.info("Performing high-performance R*Tree join and aggregation... (This may take a moment)")
 
+        # The R*Tree stores 32-bit boxes rounded outwards, so it only selects candidates; the exact half-open
+        # test on the stored coordinates then assigns each point to exactly one cell.
         aggregation_query = f"""
             SELECT
                 g.grid_id,
-                {agg_func.upper()}(p."{agg_col}") AS agg_value,
+                {agg_sql}(p."{agg_col}") AS agg_value,
                 COUNT(p.rowid) AS point_count
             FROM
                 grid_temp AS g
             JOIN
-                processed_data AS p ON ST_Contains({join_geom}, p.geom)
+                points_rtree AS r ON r.minX <= g.maxX AND r.maxX >= g.minX AND r.minY <= g.maxY AND r.maxY >= g.minY
+            JOIN
+                processed_data AS p ON p.rowid = r.id
+            WHERE
+                p.longitude >= g.minX AND p.longitude < g.maxX AND p.latitude >= g.minY AND p.latitude < g.maxY
             GROUP BY
                 g.grid_id;
         """
@@ -403,87 +783,38 @@ class ANEEL_Pipeline:
         grid_with_data = grid_gdf.merge(agg_results_df, on='grid_id')
         grid_with_data.rename(columns={'agg_value': agg_col}, inplace=True)
         
-        map_center = [grid_with_data.geometry.centroid.y.mean(), grid_with_data.geometry.centroid.x.mean()]
-        m = folium.Map(location=map_center, zoom_start=6, tiles='CartoDB positron')
-        
-        non_zero_data = grid_with_data[grid_with_data[agg_col] > 0]
-        min_val = non_zero_data[agg_col].min() if not non_zero_data.empty else 0
-        max_val = non_zero_data[agg_col].max() if not non_zero_data.empty else 0
-        if min_val == max_val: min_val = max_val * 0.9 if max_val > 0 else 0
-        colormap = cm.linear.YlOrRd_09.scale(min_val, max_val)
-        colormap.caption = f'{agg_func.capitalize()} of {agg_col} per Grid Cell'
-
-        def style_function(feature):
-            value = feature['properties'][agg_col]
-            if value > 0:
-                return {'fillColor': colormap(value), 'color': 'black', 'weight': 0.5, 'fillOpacity': 0.7}
-            else:
-                return {'fillColor': '#D3D3D3', 'color': 'black', 'weight': 0.5, 'fillOpacity': 0.5}
-
-        folium.GeoJson(grid_with_data, style_function=style_function, name='Aggregated Data',
-            tooltip=folium.GeoJsonTooltip(fields=['grid_id', agg_col, 'point_count'], aliases=['Grid ID:', f'{agg_col}:', 'Point Count:'], localize=True)
-        ).add_to(m)
-        colormap.add_to(m)
-        folium.LayerControl().add_to(m)
-        return m
+        # build_grid_cells emits cells x-major, so grid_id alone recovers each cell's (x, y) indices.
+        ix, iy = np.divmod(grid_with_data['grid_id'].to_numpy(), len(np.arange(ymin, ymax, grid_cell_size_deg)))
+        map_center = grid_center(xmin, ymin, ix, iy, grid_cell_size_deg)
+        return self._render_grid_map(grid_with_data, map_center, extra_fields={'grid_id': 'Grid ID:'})
 
     def generate_grid_map(self, grid_cell_size_arg=None):
         if not self.engine:
             logger.warning("Cannot generate map: Database engine not available."); return None
         logger.info("\n--- Generating map using high-performance arithmetic grid aggregation ---")
-        grid_cell_size_km = grid_cell_size_arg if grid_cell_size_arg is not None else config.GRID_CELL_SIZE
-        agg_col = config.AGGREGATION_COLUMN
-        agg_func = config.AGGREGATION_FUNCTION.lower()
+        grid_cell_size_km = grid_cell_size_arg if grid_cell_size_arg is not None else self.config.grid_cell_size
+        agg_col = self.config.aggregation_column
+        agg_sql = self.config.aggregation_sql
         
         # 1. Get the data bounds from the pre-calculated coordinate columns.
-        logger.info("Calculating grid bounds from coordinate columns...")
-        with self.engine.connect() as conn:
-            query = text("SELECT MIN(longitude), MIN(latitude), MAX(longitude), MAX(latitude) FROM processed_data;")
-            try:
-                xmin, ymin, xmax, ymax = conn.execute(query).fetchone()
-            except sqlalchemy.exc.OperationalError as e:
-                logger.error(f"Could not calculate data bounds. Are longitude/latitude columns missing? Error: {e}"); return None
-
-        if not all((xmin, ymin, xmax, ymax)):
-            logger.warning("Could not determine data bounds from database. Cannot generate map."); return None
+        bounds = self._query_coordinate_bounds()
+        if bounds is None: return None
+        xmin, ymin, xmax, ymax = bounds
 
         # 2. Construct and execute a single query that calculates grid indices and aggregates.
         grid_cell_size_deg = grid_cell_size_km / 111.32
         logger.info("Performing high-speed arithmetic aggregation in the database...")
 
-        # This query avoids all spatial operations and uses pure arithmetic for binning.
-        aggregation_query = f"""
-            SELECT
-                CAST(FLOOR((longitude - {xmin}) / {grid_cell_size_deg}) AS INTEGER) as grid_x_index,
-                CAST(FLOOR((latitude - {ymin}) / {grid_cell_size_deg}) AS INTEGER) as grid_y_index,
-                {agg_func.upper()}("{agg_col}") AS {agg_col},
-                COUNT(*) as point_count
-            FROM
-                processed_data
-            WHERE
-                longitude IS NOT NULL AND latitude IS NOT NULL
-            GROUP BY
-                grid_x_index, grid_y_index;
-        """
-        logger.info("Aggregation query:")
-        logger.info(aggregation_query)
-        
-        agg_results_df = pd.read_sql(aggregation_query, self.engine)
-        logger.info(f"Aggregation complete. Found data in {len(agg_results_df)} grid cells.")
+        agg_results_df = self._query_cell_aggregates(xmin, ymin, ymax, grid_cell_size_deg, agg_col, agg_sql)
 
         if agg_results_df.empty:
             logger.warning("No data points fell within the grid. Cannot create map."); return None
             
         # 3. In Python, reconstruct the grid cell polygons from the indices.
         logger.info("Reconstructing grid geometries for mapping...")
-        geometries = []
-        for index, row in agg_results_df.iterrows():
-            ix, iy = row['grid_x_index'], row['grid_y_index']
-            cell_xmin = xmin + (ix * grid_cell_size_deg)
-            cell_ymin = ymin + (iy * grid_cell_size_deg)
-            cell_xmax = cell_xmin + grid_cell_size_deg
-            cell_ymax = cell_ymin + grid_cell_size_deg
-            geometries.append(Polygon([(cell_xmin, cell_ymin), (cell_xmax, cell_ymin), (cell_xmax, cell_ymax), (cell_xmin, cell_ymax)]))
+        ix = agg_results_df['grid_x_index'].to_numpy()
+        iy = agg_results_df['grid_y_index'].to_numpy()
+        geometries = square_cells(xmin + ix * grid_cell_size_deg, ymin + iy * grid_cell_size_deg, grid_cell_size_deg)
 
         # 4. Create the final GeoDataFrame
         grid_with_data = gpd.GeoDataFrame(
@@ -493,47 +824,26 @@ class ANEEL_Pipeline:
         )
         
         # 5. Create the map using the robust manual styling method
-        map_center = [grid_with_data.geometry.centroid.y.mean(), grid_with_data.geometry.centroid.x.mean()]
-        m = folium.Map(location=map_center, zoom_start=6, tiles='CartoDB positron')
-        
-        non_zero_data = grid_with_data[grid_with_data[agg_col] > 0]
-        min_val = non_zero_data[agg_col].min() if not non_zero_data.empty else 0
-        max_val = non_zero_data[agg_col].max() if not non_zero_data.empty else 0
-        if min_val == max_val: min_val = max_val * 0.9 if max_val > 0 else 0
-        colormap = cm.linear.YlOrRd_09.scale(min_val, max_val)
-        colormap.caption = f'{agg_func.capitalize()} of {agg_col} per Grid Cell'
-
-        def style_function(feature):
-            value = feature['properties'][agg_col]
-            if value > 0:
-                return {'fillColor': colormap(value), 'color': 'black', 'weight': 0.5, 'fillOpacity': 0.7}
-            else:
-                return {'fillColor': '#D3D3D3', 'color': 'black', 'weight': 0.5, 'fillOpacity': 0.5}
-
-        folium.GeoJson(grid_with_data, style_function=style_function, name='Aggregated Data',
-            tooltip=folium.GeoJsonTooltip(fields=[agg_col, 'point_count'], aliases=[f'{agg_col}:', 'Point Count:'], localize=True)
-        ).add_to(m)
-        colormap.add_to(m)
-        folium.LayerControl().add_to(m)
-        return m
+        map_center = grid_center(xmin, ymin, grid_with_data['grid_x_index'], grid_with_data['grid_y_index'], grid_cell_size_deg)
+        return self._render_grid_map(grid_with_data, map_center)
 
 def run_full_pipeline(company_filter_arg=None, date_filter_arg=None, grid_size_arg=None, output_filename_arg=None):
     logger.info("--- Starting ANEEL BDGD Full Pipeline ---")
     pipeline = ANEEL_Pipeline()
 
     # --- FIX: Use the argument only if it's a non-empty string, otherwise use the config ---
-    company_filter = company_filter_arg if company_filter_arg else config.COMPANY_FILTER
-    date_filter = date_filter_arg if date_filter_arg else config.DATE_FILTER
-    grid_size = grid_size_arg if grid_size_arg else config.GRID_CELL_SIZE
-    output_filename = output_filename_arg if output_filename_arg else config.OUTPUT_FILENAME
+    company_filter = company_filter_arg if company_filter_arg else pipeline.config.company_filter
+    date_filter = date_filter_arg if date_filter_arg else pipeline.config.date_filter
+    grid_size = grid_size_arg if grid_size_arg else pipeline.config.grid_cell_size
+    output_filename = output_filename_arg if output_filename_arg else pipeline.config.output_filename
     
     features_to_download = pipeline.search_and_filter(company_filter, date_filter)
     if not features_to_download: 
         logger.warning("No datasets found matching filters. Exiting.")
         return
 
-    if config.MAX_DOWNLOADS: 
-        features_to_download = features_to_download[:config.MAX_DOWNLOADS]
+    if pipeline.config.max_downloads: 
+        features_to_download = features_to_download[:pipeline.config.max_downloads]
     
     gdb_paths = pipeline.download_and_extract_from_features(features_to_download)
     if gdb_paths:
@@ -566,8 +876,8 @@ def perform_search(company_filter, date_filter):
             print(f"  - Tags: {props.get('tags')}")
             print(f"  - Size: {props.get('size', 0) / 1024 / 1024:.2f} MB")
         print("-" * 50)
-        logger.info("Use the 'Title' or parts of it for the COMPANY_FILTER in config.py")
-        logger.info("Use parts of the 'Name' (like '2023-12-31') for the DATE_FILTER in config.py")
+        logger.info("Use the 'Title' or parts of it for the company_filter in config.toml")
+        logger.info("Use parts of the 'Name' (like '2023-12-31') for the date_filter in config.toml")
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="ANEEL BDGD Downloader and Mapper")
@@ -2,7 +2,7 @@
 setlocal
 
 ECHO --- Running ANEEL BDGD Downloader and Mapper (Full Pipeline) ---
-ECHO This will download and process files based on your 'config.py' settings.
+ECHO This will download and process files based on your 'config.toml' settings.
 ECHO Command-line arguments will override the settings in the config file.
 ECHO.
 
@@ -33,9 +33,9 @@ conda env list | findstr /B /C:"%ENV_NAME% " >nul
 IF %ERRORLEVEL% EQU 0 (
     ECHO Environment '%ENV_NAME%' already exists. Skipping creation.
 ) ELSE (
-    ECHO Creating new Conda environment '%ENV_NAME%' with Python 3.9...
+    ECHO Creating new Conda environment '%ENV_NAME%' with Python 3.11...
     ECHO This may take a few minutes. Please be patient.
-    conda create --name %ENV_NAME% python=3.9 -y
+    conda create --name %ENV_NAME% python=3.11 -y
     IF %ERRORLEVEL% NEQ 0 (
         ECHO ERROR: Failed to create the Conda environment. Please check your Conda installation.
         PAUSE
@@ -48,7 +48,7 @@ REM --- Step 3: Install All Packages in One Go ---
 ECHO Installing all required packages into '%ENV_NAME%'...
 ECHO This includes libspatialite and all Python dependencies from the conda-forge channel.
 ECHO This is the most reliable method and may also take a few minutes.
-conda install --name %ENV_NAME% -c conda-forge libspatialite geopandas fiona pyproj shapely folium tqdm pandas matplotlib sqlalchemy geoalchemy2 requests -y
+conda install --name %ENV_NAME% -c conda-forge libspatialite geopandas pyogrio pyarrow pyproj shapely folium tqdm pandas matplotlib sqlalchemy geoalchemy2 requests urllib3 numba -y
 IF %ERRORLEVEL% NEQ 0 (
     ECHO ERROR: Failed to install packages into the Conda environment.
     ECHO Please check your internet connection and try again.